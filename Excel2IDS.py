@@ -4,13 +4,21 @@
 import os
 import sys
 import time
-import copy
-import openpyxl
-from ifctester import ids
-from tqdm import tqdm
 import json
 import re
 import datetime
+from collections import namedtuple
+import multiprocessing
+import argparse
+import glob
+import hashlib
+import importlib
+import functools
+import contextlib
+import threading
+from xml.etree import ElementTree as ET
+# openpyxl, ifctester, tqdm and the other slow to import modules are imported by the functions using them,
+# so that the tool starts (and asks for the path) without waiting for them.
 
 
 class Settings:
@@ -20,250 +28,713 @@ class Settings:
         for key, value in settings_dict.items():
             setattr(self, key, value)
 
+    @functools.cached_property
+    def index(self):
+        return self.resolve({key: value for key, value in vars(self).items() if key != 'index'})
+
+    @staticmethod
+    def resolve(settings_dict):
+        """ Convert cell addresses, row numbers and column letters to 0-based grid indexes """
+        import openpyxl
+        index = {}
+        for key, value in settings_dict.items():
+            if key.startswith(('SPE_', 'APL_')):
+                index[key] = int(value) - 1
+            elif key.startswith('REQ_'):
+                index[key] = openpyxl.utils.column_index_from_string(value) - 1
+            elif key in CELL_KEYS:
+                row, col = openpyxl.utils.cell.coordinate_to_tuple(value)
+                index[key] = (row - 1, col - 1)
+        return index
+
+
+MILESTONE = 'LOD400' #TODO TEMP workaround for phases/milestones
+
+# Version of the IDS files written for the same spreadsheet. Increase it whenever a change in the code changes them,
+# so that the files saved by older versions are not kept as up to date (see input_hashes).
+FORMAT_VERSION = 2
+
+CELL_KEYS = ['IDS_TITLE', 'IDS_AUTHOR', 'IDS_DATE', 'IDS_VERSION', 'IDS_COPYRIGHT', 'IFC_VERSION', 'IDS_DESCRIPTION', 'DEFAULT_START_CELL']
+
+
+class Grid:
+    """ Values of the whole worksheet, read in a single pass into equally long rows """
+    def __init__(self, worksheet, settings):
+        self.index = settings.index
+        # make sure all the cells referenced in settings are inside the grid
+        width, height = worksheet.max_column or 0, 0
+        for key, index in self.index.items():
+            if isinstance(index, tuple):
+                width, height = max(width, index[1] + 1), max(height, index[0] + 1)
+            elif key.startswith('REQ_'):
+                width = max(width, index + 1)
+            else:
+                height = max(height, index + 1)
+        # read-only worksheets cut the rows at the dimensions saved in the file, which may be wrong,
+        # so they are only used as the first guess of the width
+        if hasattr(worksheet, 'reset_dimensions'):
+            worksheet.reset_dimensions()
+        # pad each row as it is read, so that the sheet is copied only once
+        self.rows = []
+        short_rows = False
+        for row in worksheet.iter_rows(values_only=True):
+            if len(row) > width:
+                # the sheet is wider than its saved dimensions
+                width, short_rows = len(row), True
+            self.rows.append(tuple(row) + (None,) * (width - len(row)))
+        if short_rows:
+            self.rows = [row if len(row) == width else row + (None,) * (width - len(row)) for row in self.rows]
+        self.rows += [(None,) * width] * (height - len(self.rows))
+        self.max_column = width
+        self.max_row = len(self.rows)
+
+    def cell(self, key):
+        row, col = self.index[key]
+        return self.rows[row][col]
+
+
+def read_grid(file_path, settings):
+    """ Open the workbook read-only and take a snapshot of the values of the requirements sheet """
+    import openpyxl
+    spreadsheet = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        return Grid(spreadsheet[settings.SHEET_NAME], settings)
+    finally:
+        spreadsheet.close()
+
+
+class Report:
+    """ Wall and CPU time of each stage of a conversion, and counters of the work done, to be saved as JSON.
+    Optionally profiles the run with cProfile (saved to profile_path) and records the peak traced memory.
+    """
+    def __init__(self, profile_path=None, trace_memory=False):
+        self.stages = {}
+        self.counters = {}
+        self.bytes_written = {}
+        self.profile_path = profile_path
+        self.trace_memory = trace_memory
+        self.peak_memory = None
+        self.profiler = None
+        self.validation = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            stage['wall'] += time.perf_counter() - wall
+            stage['cpu'] += time.process_time() - cpu
+            stage['calls'] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def start(self):
+        import cProfile
+        import tracemalloc
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.profile_path:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        import tracemalloc
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+            self.profiler = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def asdict(self):
+        result = {
+            'stages': self.stages,
+            'counters': self.counters,
+            'bytes_written': self.bytes_written,
+            'value_caches': value_cache_info(),
+        }
+        if self.peak_memory is not None:
+            result['peak_memory'] = self.peak_memory
+        if self.validation is not None:
+            result['validation'] = self.validation
+        return result
+
+
+def save_report(report_path, report_dict):
+    with open(report_path, 'w') as file:
+        json.dump(report_dict, file, indent=1)
+
 
 def isempty(v):
     return (v is None or v == '')
 
 
-def excel2ids(spreadsheet, ids_path):
-    sheet = spreadsheet[s.SHEET_NAME]
+REQ_VALUE_KEYS = [
+    'REQ_CARDINAL', 'REQ_ENTITY', 'REQ_PRED_TYPE', 'REQ_PSET', 'REQ_PNAME', 'REQ_PVAL', 'REQ_PDTYPE', 'REQ_URI',
+    'REQ_CLASS_SYS', 'REQ_CLASS_CODE', 'REQ_CLASS_URI', 'REQ_ANAME', 'REQ_AVALUE', 'REQ_MATERIAL',
+]
+
+
+class RestrictionData(namedtuple('RestrictionData', ['constraint', 'value'])):
+    """ A pattern (string) or enumeration (tuple) restriction, converted to ids.Restriction only when saving """
+    __slots__ = ()
+
+    def to_ids(self):
+        from ifctester import ids
+        value = list(self.value) if isinstance(self.value, tuple) else self.value
+        return ids.Restriction(options={self.constraint: value})
+
+
+class FacetData(namedtuple('FacetData', ['kind', 'parameters'])):
+    """ An IDS facet, kind being the ifctester class name and parameters a tuple of (argument, value) pairs """
+    __slots__ = ()
+
+    def to_ids(self):
+        from ifctester import ids
+        parameters = {
+            name: value.to_ids() if isinstance(value, RestrictionData) else value for name, value in self.parameters
+        }
+        return getattr(ids, self.kind)(**parameters)
+
+
+class SpecificationData(namedtuple('SpecificationData', [
+    'name', 'minOccurs', 'maxOccurs', 'ifcVersion', 'identifier', 'description', 'instructions', 'applicability', 'requirements'
+])):
+    """ An IDS specification with tuples of FacetData as applicability and requirements """
+    __slots__ = ()
+
+    def to_ids(self):
+        from ifctester import ids
+        spec = ids.Specification(
+            name=self.name,
+            minOccurs=self.minOccurs,
+            maxOccurs=self.maxOccurs,
+            ifcVersion=self.ifcVersion,
+            identifier=self.identifier,
+            description=self.description,
+            instructions=self.instructions,
+        )
+        spec.applicability = [facet.to_ids() for facet in self.applicability]
+        spec.requirements = [facet.to_ids() for facet in self.requirements]
+        return spec
+
+
+class IdsData:
+    """ The info and the (SpecificationData) specifications of a single IDS.
+    sources holds, for each specification, the spreadsheet columns it comes from and the (row, column) of the mark
+    that added each of its requirements.
+    """
+    __slots__ = ('info', 'specifications', 'sources')
+
+    def __init__(self, info, specifications=None, sources=None):
+        self.info = info
+        self.specifications = specifications or []
+        self.sources = sources or []
+
+    def to_ids(self):
+        from ifctester import ids
+        new_ids = ids.Ids()
+        new_ids.info = self.info
+        new_ids.specifications = [spec.to_ids() for spec in self.specifications]
+        return new_ids
+
+
+def facet(kind, instructions=None, **parameters):
+    if instructions:
+        parameters['instructions'] = instructions
+    return FacetData(kind, tuple(parameters.items()))
+
+
+def entity_facet(v, instructions=None):
+    return facet('Entity', instructions, name=v['REQ_ENTITY'], predefinedType=v['REQ_PRED_TYPE'] or None)
+
+
+def property_facet(v, instructions=None):
+    parameters = dict(
+        propertySet=v['REQ_PSET'],
+        baseName=v['REQ_PNAME'],
+        dataType=v['REQ_PDTYPE'],
+        cardinality=v['REQ_CARDINAL']
+    )
+    if not isempty(v['REQ_PVAL']):
+        parameters['value'] = v['REQ_PVAL']
+    if not isempty(v['REQ_URI']):
+        parameters['uri'] = v['REQ_URI']
+    return facet('Property', instructions, **parameters)
+
+
+def classification_facet(v, instructions=None):
+    parameters = dict(
+        system=v['REQ_CLASS_SYS'],
+        value=v['REQ_CLASS_CODE'],
+        cardinality=v['REQ_CARDINAL']
+    )
+    if not isempty(v['REQ_CLASS_URI']):
+        parameters['uri'] = v['REQ_CLASS_URI']
+    return facet('Classification', instructions, **parameters)
+
+
+def attribute_facet(v, instructions=None):
+    return facet('Attribute', instructions, name=v['REQ_ANAME'], value=v['REQ_AVALUE'], cardinality=v['REQ_CARDINAL'])
+
+
+def material_facet(v, instructions=None):
+    return facet('Material', instructions, value=v['REQ_MATERIAL'], cardinality=v['REQ_CARDINAL'])
+
+
+# Column holding 'REPLACEME' -> facet built from the value in the assignment cell (first match wins)
+REPLACEABLE = {
+    'REQ_ENTITY': entity_facet,
+    'REQ_PSET': property_facet,
+    'REQ_PNAME': property_facet,
+    'REQ_PVAL': property_facet,
+    'REQ_CLASS_SYS': classification_facet,
+    'REQ_CLASS_CODE': classification_facet,
+    'REQ_ANAME': attribute_facet,
+    'REQ_AVALUE': attribute_facet,
+    'REQ_MATERIAL': material_facet,
+}
+
+
+# IDS facet -> child element or attribute -> settings key of the cell holding it
+APPLICABILITY_CELLS = {
+    'entity': {'name': 'APL_ENTITY', 'predefinedType': 'APL_PRED_TYPE'},
+    'property': {'propertySet': 'APL_PSET', 'baseName': 'APL_PNAME', 'value': 'APL_PVAL', 'dataType': 'APL_PDTYPE'},
+    'classification': {'system': 'APL_CLASS_SYS', 'value': 'APL_CLASS_CODE'},
+    'attribute': {'name': 'APL_ANAME', 'value': 'APL_AVALUE'},
+    'material': {'value': 'APL_MATERIAL'},
+}
+
+REQUIREMENT_CELLS = {
+    'entity': {'name': 'REQ_ENTITY', 'predefinedType': 'REQ_PRED_TYPE', 'instructions': 'REQ_INSTRUCTIONS'},
+    'property': {
+        'propertySet': 'REQ_PSET', 'baseName': 'REQ_PNAME', 'value': 'REQ_PVAL', 'dataType': 'REQ_PDTYPE', 'uri': 'REQ_URI',
+        'cardinality': 'REQ_CARDINAL', 'instructions': 'REQ_INSTRUCTIONS',
+    },
+    'classification': {
+        'system': 'REQ_CLASS_SYS', 'value': 'REQ_CLASS_CODE', 'uri': 'REQ_CLASS_URI',
+        'cardinality': 'REQ_CARDINAL', 'instructions': 'REQ_INSTRUCTIONS',
+    },
+    'attribute': {'name': 'REQ_ANAME', 'value': 'REQ_AVALUE', 'cardinality': 'REQ_CARDINAL', 'instructions': 'REQ_INSTRUCTIONS'},
+    'material': {'value': 'REQ_MATERIAL', 'cardinality': 'REQ_CARDINAL', 'instructions': 'REQ_INSTRUCTIONS'},
+}
+
+SPECIFICATION_CELLS = {
+    'name': 'SPE_NAME', 'description': 'SPE_DESCR', 'instructions': 'SPE_INSTR', 'identifier': 'SPE_IDENT',
+    'ifcVersion': 'IFC_VERSION', 'minOccurs': 'APL_CARDINAL', 'maxOccurs': 'APL_CARDINAL',
+}
+
+INFO_CELLS = {
+    'title': 'IDS_TITLE', 'author': 'IDS_AUTHOR', 'date': 'IDS_DATE', 'version': 'IDS_VERSION',
+    'copyright': 'IDS_COPYRIGHT', 'description': 'IDS_DESCRIPTION',
+}
+
+
+class RequirementRow:
+    """ A single requirement row, parsed once and shared by every column that marks it """
+    def __init__(self, raw_values, instructions=None):
+        self.instructions = instructions
+        self.values = {key: process_value(raw_values[key]) for key in REQ_VALUE_KEYS}
+        self.replace_key = next((key for key in REPLACEABLE if raw_values[key] == 'REPLACEME'), None)
+        self.facets = []
+        if self.values['REQ_ENTITY']:
+            self.facets.append(entity_facet(self.values, instructions))
+        if not isempty(self.values['REQ_PNAME']):
+            self.facets.append(property_facet(self.values, instructions))
+        if not isempty(self.values['REQ_CLASS_SYS']):
+            self.facets.append(classification_facet(self.values, instructions))
+        if not isempty(self.values['REQ_ANAME']):
+            self.facets.append(attribute_facet(self.values, instructions))
+        if not isempty(self.values['REQ_MATERIAL']):
+            self.facets.append(material_facet(self.values, instructions))
+
+    def replace(self, cell_value):
+        """ Build the facet for a 'REPLACEME' row, using the assignment cell value in place of 'REPLACEME'. """
+        if not self.replace_key:
+            return None
+        values = dict(self.values)
+        values[self.replace_key] = process_value(cell_value)
+        return REPLACEABLE[self.replace_key](values, self.instructions)
+
+
+def read_requirement_rows(grid, settings, start_row, end_row, cache=None):
+    """ Parse all included requirement rows into facets, once per run.
+    With a cache (dictionary), rows with the same content as in a previous run reuse its facets.
+    Entries of the cache for rows which are no longer in the grid are dropped.
+    """
+    requirement_rows = {}
+    used = set()
+    include = settings.index['REQ_INCLUDE']
+    instructions = settings.index['REQ_INSTRUCTIONS']
+    value_columns = [(key, settings.index[key]) for key in REQ_VALUE_KEYS]
+    for row in range(start_row, end_row):
+        row_values = grid.rows[row]
+        if row_values[include]:
+            raw_values = {key: row_values[col] for key, col in value_columns}
+            if cache is None:
+                requirement_rows[row] = RequirementRow(raw_values, row_values[instructions])
+                continue
+            # repr tells apart values which are equal in Python but not in the IDS, like True, 1 and 1.0
+            key = repr((row_values[instructions], *raw_values.values()))
+            if key not in cache:
+                cache[key] = RequirementRow(raw_values, row_values[instructions])
+            requirement_rows[row] = cache[key]
+            used.add(key)
+    if cache is not None:
+        for key in cache.keys() - used:
+            del cache[key]
+    return requirement_rows
+
+
+def index_marks(grid, requirement_rows, start_col):
+    """ Map each column of the assignment table to its marked (row, cell value) pairs, skipping empty cells """
+    marks = {}
+    for row in requirement_rows:
+        for col, cell_value in enumerate(grid.rows[row][start_col:], start_col):
+            if not isempty(cell_value):
+                marks.setdefault(col, []).append((row, cell_value))
+    return marks
+
+
+def read_applicability(value):
+    """ Build the applicability facets of a specification column. value(key) returns the cell of that column in row 'key'. """
+    applicability = []
+    # add entity and predefined type
+    entity_cell = process_value(value('APL_ENTITY'))
+    predefined_type_cell = process_value(value('APL_PRED_TYPE'))
+    if entity_cell:
+        if predefined_type_cell:
+            entity = facet('Entity', name=entity_cell, predefinedType=predefined_type_cell)
+        else:
+            entity = facet('Entity', name=entity_cell)
+        # if '.' in entity_cell:
+        #     entity = ids.Entity(name=entity_cell.split('.')[0].upper(), predefinedType=entity_cell.split('.')[1].upper())
+        # else:
+        applicability.append(entity)
+    # add property
+    if value('APL_PNAME'):
+        property = dict(
+            propertySet=process_value(value('APL_PSET')), 
+            baseName=process_value(value('APL_PNAME')),
+            dataType=process_value(value('APL_PDTYPE'))
+            )             
+        pv = value('APL_PVAL')
+        if not isempty(pv):
+            property['value'] = process_value(pv)
+        applicability.append(facet('Property', **property))
+    # add classification
+    if not isempty(value('APL_CLASS_SYS')):
+        classification = facet('Classification',
+            system=process_value(value('APL_CLASS_SYS')),
+            value=process_value(value('APL_CLASS_CODE')))
+        applicability.append(classification)
+    # add attribute
+    if not isempty(value('APL_ANAME')):
+        attribute = facet('Attribute',
+            name=process_value(value('APL_ANAME')),
+            value=process_value(value('APL_AVALUE'))
+        )
+        applicability.append(attribute)
+    # add material
+    if not isempty(value('APL_MATERIAL')):
+        material = facet('Material',
+            value=process_value(value('APL_MATERIAL'))
+        )
+        applicability.append(material)
+    return applicability
+
+
+def column_requirements(column_marks, requirement_rows, report):
+    """ Collect the requirement facets of the rows marked in a specification column, and the row of each facet """
+    requirements = []
+    rows = []
+    for row, cell_value in column_marks:
+        if str(cell_value).strip().upper() == "X":
+            requirements += requirement_rows[row].facets
+            rows += [row] * len(requirement_rows[row].facets)
+        else:
+            # process 'REPLACEME'
+            facet = requirement_rows[row].replace(cell_value)
+            if facet:
+                report.count('facets_built')
+                requirements.append(facet)
+                rows.append(row)
+            else:
+                print(color_text(f"The only allowed values are 'X' and 'REPLACEME' but your table has: '{cell_value}'.", color='red'))
+    return requirements, rows
+
+
+def excel2ids(grid, settings, milestone=MILESTONE, verbose=True, purposes=None, report=None, requirement_cache=None):
+    """ Convert the spreadsheet grid into IDS specifications, split by purpose. Returns a dictionary of purpose -> IdsData
+    If purposes is given, only the IDS for those purposes are built. Timings and counters are added to the report.
+    requirement_cache keeps the parsed requirement rows between runs (see read_requirement_rows).
+    """
+    if report is None:
+        report = Report()
+    with report.stage('imports'):
+        # imported up front, so that loading ifctester isn't counted in the first add_to_ids stage
+        import openpyxl
+        from tqdm import tqdm
+        importlib.import_module('ifctester.ids')
+    restrictions_before = restriction.cache_info().misses
+    merges = 0
+    ids_list = {}
+    spec_index = {} # purpose -> specification name -> specification
+    rows = grid.rows
     # Define the starting cell of the assignment table
-    start_row = sheet[s.DEFAULT_START_CELL].row
-    start_col = sheet[s.DEFAULT_START_CELL].column
-    end_row = sheet.max_row + 1
-    end_col = sheet.max_column + 1
+    start_row, start_col = settings.index['DEFAULT_START_CELL']
+    end_row = grid.max_row
+    end_col = grid.max_column
+    with report.stage('requirement_rows'):
+        requirement_rows = read_requirement_rows(grid, settings, start_row, end_row, cache=requirement_cache)
+    report.count('requirement_rows', len(requirement_rows))
+    report.count('facets_built', sum(len(requirement_row.facets) for requirement_row in requirement_rows.values()))
+    with report.stage('index_marks'):
+        marks = index_marks(grid, requirement_rows, start_col)
+    report.count('marks', sum(len(column_marks) for column_marks in marks.values()))
+
+    ifc_version = grid.cell('IFC_VERSION')
+    if not ifc_version in ['IFC2X3','IFC4','IFC4X3_ADD2']:
+        ifc_version = settings.IFC_VERSION_DEFAULT
+    header = dict(
+        milestone=milestone, #TODO process milestone/phases REQ_MILESTONE
+        ifc_version=ifc_version,
+        title=grid.cell('IDS_TITLE'),
+        author=grid.cell('IDS_AUTHOR'),
+        date=grid.cell('IDS_DATE'),
+        version=grid.cell('IDS_VERSION'),
+        copyright=grid.cell('IDS_COPYRIGHT'),
+        description=grid.cell('IDS_DESCRIPTION'),
+    )
+
+    for col in tqdm(range(start_col, end_col), desc="Processing Excel columns.", disable=not verbose):
+        value = lambda key: rows[settings.index[key]][col]
+
+        column_purpose_list = column_purposes(value('APL_PURPOSE'))
+        if value('APL_INCLUDE') and not column_purpose_list:
+            report.count('columns_without_purpose')
+            if verbose:
+                column_letter = openpyxl.utils.get_column_letter(col + 1)
+                print(color_text(f"Column {column_letter} is skipped, as it has no purpose.", color='red'))
+            continue
 
-    for col in tqdm(range(start_col, end_col), desc="Processing Excel columns."):
-        column_letter = openpyxl.utils.get_column_letter(col)
+        if purposes is not None and not purposes.intersection(column_purpose_list):
+            continue
 
-        if sheet[f'{column_letter}{s.APL_INCLUDE}'].value:
+        if value('APL_INCLUDE'):
             ### add applicability
-            applicability = []
-            cardinality = sheet[f'{column_letter}{s.APL_CARDINAL}'].value
-            # add entity and predefined type
-            entity_cell = process_value(sheet[f'{column_letter}{s.APL_ENTITY}'].value)
-            predefined_type_cell = process_value(sheet[f'{column_letter}{s.APL_PRED_TYPE}'].value)
-            if entity_cell:
-                if predefined_type_cell:
-                    entity = ids.Entity(name=entity_cell, predefinedType=predefined_type_cell)
-                else:
-                    entity = ids.Entity(name=entity_cell)
-                # if '.' in entity_cell:
-                #     entity = ids.Entity(name=entity_cell.split('.')[0].upper(), predefinedType=entity_cell.split('.')[1].upper())
-                # else:
-                applicability.append(entity)
-            # add property
-            if sheet[f'{column_letter}{s.APL_PNAME}'].value:
-                property = ids.Property(
-                    propertySet=process_value(sheet[f'{column_letter}{s.APL_PSET}'].value), 
-                    baseName=process_value(sheet[f'{column_letter}{s.APL_PNAME}'].value),
-                    dataType=process_value(sheet[f'{column_letter}{s.APL_PDTYPE}'].value)
-                    )             
-                pv = sheet[f"{column_letter}{s.APL_PVAL}"].value
-                if not isempty(pv):
-                    property.value = process_value(pv)
-                applicability.append(property)
-            # add classification
-            if not isempty(sheet[f'{column_letter}{s.APL_CLASS_SYS}'].value):
-                classification = ids.Classification(
-                    system=process_value(sheet[f'{column_letter}{s.APL_CLASS_SYS}'].value),
-                    value=process_value(sheet[f'{column_letter}{s.APL_CLASS_CODE}'].value))
-                applicability.append(classification)
-            # add attribute
-            if not isempty(sheet[f'{column_letter}{s.APL_ANAME}'].value):
-                attribute = ids.Attribute(
-                    name=process_value(sheet[f'{column_letter}{s.APL_ANAME}'].value),
-                    value=process_value(sheet[f'{column_letter}{s.APL_AVALUE}'].value)
-                )
-                applicability.append(attribute)
-            # add material
-            if not isempty(sheet[f'{column_letter}{s.APL_MATERIAL}'].value):
-                material = ids.Material(
-                    value=process_value(sheet[f'{column_letter}{s.APL_MATERIAL}'].value)
-                )
-                applicability.append(material)
+            cardinality = value('APL_CARDINAL')
+            with report.stage('applicability'):
+                applicability = read_applicability(value)
+            report.count('facets_built', len(applicability))
 
             ### add requirement(s)
-            requirements = []
-            for row in range(start_row, end_row):
-                if sheet[f'{s.REQ_INCLUDE}{row}'].value:
-                    cell_value = sheet.cell(row=row, column=col).value
-                    if not isempty(cell_value):
-                        if cell_value.strip().upper() == "X":
-                            instructions = sheet[f'{s.REQ_INSTRUCTIONS}{row}'].value
-                            # add entity and predefined type
-                            entity_cell = process_value(sheet[f'{s.REQ_ENTITY}{row}'].value)
-                            predefined_type_cell = process_value(sheet[f'{s.REQ_PRED_TYPE}{row}'].value)
-                            if entity_cell:
-                                if predefined_type_cell:
-                                    entity = ids.Entity(name=entity_cell, predefinedType=predefined_type_cell)
-                                else:
-                                    entity = ids.Entity(name=entity_cell)
-                                if instructions:
-                                    entity.instructions=instructions
-                                requirements.append(entity)
-                            # add property
-                            if not isempty(sheet[f'{s.REQ_PNAME}{row}'].value):
-                                property = ids.Property(
-                                    propertySet=process_value(sheet[f'{s.REQ_PSET}{row}'].value), 
-                                    baseName=process_value(sheet[f'{s.REQ_PNAME}{row}'].value),
-                                    dataType=process_value(sheet[f'{s.REQ_PDTYPE}{row}'].value),
-                                    cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value)
-                                )
-                                if not isempty(sheet[f'{s.REQ_PVAL}{row}'].value):
-                                    property.value = process_value(sheet[f'{s.REQ_PVAL}{row}'].value)
-                                if not isempty(sheet[f'{s.REQ_URI}{row}'].value):
-                                    property.uri = process_value(sheet[f'{s.REQ_URI}{row}'].value)
-                                if instructions:
-                                    property.instructions=instructions
-                                requirements.append(property)
-                            # add classification
-                            if not isempty(sheet[f'{s.REQ_CLASS_SYS}{row}'].value):
-                                classification = ids.Classification(
-                                    system=process_value(sheet[f'{s.REQ_CLASS_SYS}{row}'].value),
-                                    value=process_value(sheet[f'{s.REQ_CLASS_CODE}{row}'].value),
-                                    cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value)
-                                )
-                                if not isempty(sheet[f'{s.REQ_CLASS_URI}{row}'].value):
-                                    classification.uri = process_value(sheet[f'{s.REQ_CLASS_URI}{row}'].value)
-                                if instructions:
-                                    classification.instructions=instructions
-                                requirements.append(classification)
-                            # add attribute
-                            if not isempty(sheet[f'{s.REQ_ANAME}{row}'].value):
-                                attribute = ids.Attribute(
-                                    name=process_value(sheet[f'{s.REQ_ANAME}{row}'].value),
-                                    value=process_value(sheet[f'{s.REQ_AVALUE}{row}'].value),
-                                    cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value)
-                                )
-                                if instructions:
-                                    attribute.instructions=instructions
-                                requirements.append(attribute)
-                            # add material
-                            if not isempty(sheet[f'{s.REQ_MATERIAL}{row}'].value):
-                                material = ids.Material(
-                                    value=process_value(sheet[f'{s.REQ_MATERIAL}{row}'].value),
-                                    cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value)
-                                )
-                                if instructions:
-                                    material.instructions=instructions
-                                requirements.append(material)         
-                        else:
-                            # process 'REPLACEME'
-                            cell_value = process_value(cell_value)
-                            if sheet[f'{s.REQ_ENTITY}{row}'].value == 'REPLACEME':
-                                if predefined_type_cell:
-                                    facet = ids.Entity(name=cell_value, predefinedType=predefined_type_cell)
-                                else:
-                                    facet = ids.Entity(name=cell_value)
-                            elif sheet[f'{s.REQ_PSET}{row}'].value == 'REPLACEME':
-                                facet = ids.Property(
-                                    propertySet=cell_value, 
-                                    baseName=process_value(sheet[f'{s.REQ_PNAME}{row}'].value),
-                                    dataType=process_value(sheet[f'{s.REQ_PDTYPE}{row}'].value),
-                                    cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value)
-                                )
-                                if not isempty(sheet[f'{s.REQ_PVAL}{row}'].value):
-                                    property.value = process_value(sheet[f'{s.REQ_PVAL}{row}'].value)
-                                if not isempty(sheet[f'{s.REQ_URI}{row}'].value):
-                                    property.uri = process_value(sheet[f'{s.REQ_URI}{row}'].value)
-                            elif sheet[f'{s.REQ_PNAME}{row}'].value == 'REPLACEME':
-                                facet = ids.Property(
-                                    propertySet=process_value(sheet[f'{s.REQ_PSET}{row}'].value), 
-                                    baseName=cell_value,
-                                    dataType=process_value(sheet[f'{s.REQ_PDTYPE}{row}'].value),
-                                    cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value)
-                                )
-                                if not isempty(sheet[f'{s.REQ_PVAL}{row}'].value):
-                                    property.value = process_value(sheet[f'{s.REQ_PVAL}{row}'].value)
-                                if not isempty(sheet[f'{s.REQ_URI}{row}'].value):
-                                    property.uri = process_value(sheet[f'{s.REQ_URI}{row}'].value)
-                            elif sheet[f'{s.REQ_PVAL}{row}'].value == 'REPLACEME':
-                                facet = ids.Property(
-                                    propertySet=process_value(sheet[f'{s.REQ_PSET}{row}'].value), 
-                                    baseName=process_value(sheet[f'{s.REQ_PNAME}{row}'].value),
-                                    dataType=process_value(sheet[f'{s.REQ_PDTYPE}{row}'].value),
-                                    cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value),
-                                    value = cell_value
-                                )
-                                if not isempty(sheet[f'{s.REQ_URI}{row}'].value):
-                                    property.uri = process_value(sheet[f'{s.REQ_URI}{row}'].value)
-                            elif sheet[f'{s.REQ_CLASS_SYS}{row}'].value == 'REPLACEME':
-                                facet = ids.Classification(
-                                    system=cell_value,
-                                    value=process_value(sheet[f'{s.REQ_CLASS_CODE}{row}'].value),
-                                    cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value)
-                                    )
-                                if not isempty(sheet[f'{s.REQ_CLASS_URI}{row}'].value):
-                                    facet.uri = process_value(sheet[f'{s.REQ_CLASS_URI}{row}'].value)
-                            elif sheet[f'{s.REQ_CLASS_CODE}{row}'].value == 'REPLACEME':
-                                facet = ids.Classification(
-                                    system=process_value(sheet[f'{s.REQ_CLASS_SYS}{row}'].value),
-                                    value=cell_value,
-                                    cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value)
-                                    )
-                                if not isempty(sheet[f'{s.REQ_CLASS_URI}{row}'].value):
-                                    facet.uri = process_value(sheet[f'{s.REQ_CLASS_URI}{row}'].value)
-                            elif sheet[f'{s.REQ_ANAME}{row}'].value == 'REPLACEME':
-                                facet = ids.Attribute(
-                                    name=cell_value,
-                                    value=process_value(sheet[f'{s.REQ_AVALUE}{row}'].value),
-                                    cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value)
-                                )       
-                            elif sheet[f'{s.REQ_AVALUE}{row}'].value == 'REPLACEME':
-                                facet = ids.Attribute(
-                                    name=process_value(sheet[f'{s.REQ_ANAME}{row}'].value),
-                                    value=cell_value,
-                                    cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value)
-                                )                                          
-                            elif sheet[f'{s.REQ_MATERIAL}{row}'].value == 'REPLACEME':
-                                facet = ids.Material(value=cell_value, cardinality=process_value(sheet[f'{s.REQ_CARDINAL}{row}'].value))
-                            
-                            if facet:
-                                if instructions:
-                                    facet.instructions=instructions
-                                requirements.append(facet)
-                            else:
-                                print(color_text(f"The only allowed values are 'X' and 'REPLACEME' but your table has: '{cell_value}'.", color='red'))
+            with report.stage('requirements'):
+                requirements, requirement_rows_used = column_requirements(marks.get(col, []), requirement_rows, report)
 
             if requirements or cardinality == 'prohibited':
-                disciplines = split_multivalue(sheet[f"{column_letter}{s.APL_PURPOSE}"].value)
-                ifc_version = sheet[s.IFC_VERSION].value
-                if not ifc_version in ['IFC2X3','IFC4','IFC4X3_ADD2']:
-                    ifc_version = s.IFC_VERSION_DEFAULT
-                for discipline in disciplines:
-                    add_to_ids(
-                        applicability,
-                        requirements,
-                        apl_cardinality=cardinality,
-                        purpose=discipline,
-                        spec_name=sheet[f"{column_letter}{s.SPE_NAME}"].value,
-                        spec_description=sheet[f"{column_letter}{s.SPE_DESCR}"].value,
-                        spec_instructions=sheet[f"{column_letter}{s.SPE_INSTR}"].value,
-                        spec_identifier=sheet[f"{column_letter}{s.SPE_IDENT}"].value,
-                        #TODO process milestone/phases REQ_MILESTONE
-                        milestone=MILESTONE,
-                        ifc_version=ifc_version,
-                        title=sheet[s.IDS_TITLE].value,
-                        author=sheet[s.IDS_AUTHOR].value,
-                        date=sheet[s.IDS_DATE].value,
-                        version=sheet[s.IDS_VERSION].value,
-                        copyright=sheet[s.IDS_COPYRIGHT].value,
-                        description=sheet[s.IDS_DESCRIPTION].value,
-                    )
+                for discipline in column_purpose_list:
+                    if purposes is not None and discipline not in purposes:
+                        continue
+                    merges += 1
+                    with report.stage('add_to_ids'):
+                        add_to_ids(
+                            ids_list,
+                            spec_index,
+                            applicability,
+                            requirements,
+                            apl_cardinality=cardinality,
+                            purpose=discipline,
+                            spec_name=value('SPE_NAME'),
+                            spec_description=value('SPE_DESCR'),
+                            spec_instructions=value('SPE_INSTR'),
+                            spec_identifier=value('SPE_IDENT'),
+                            column=col,
+                            requirement_cells=[(row, col) for row in requirement_rows_used],
+                            **header,
+                        )
 
-    ### Save all IDSes to files:
-    for new_ids in tqdm(ids_list, desc="Generating separate .ids files."):
-        ids_list[new_ids].to_xml(ids_path.replace(".ids", "_" + new_ids + ".ids"))
-    print(
-        color_text(f"Success! {len(ids_list)} IDS files were saved in {os.path.dirname(ids_path)}.", color='green')
+    specifications = sum(len(ids_list[purpose].specifications) for purpose in ids_list)
+    report.count('specifications_created', specifications)
+    report.count('specifications_merged', merges - specifications)
+    report.count('restrictions_created', restriction.cache_info().misses - restrictions_before)
+    return ids_list
+
+
+def convert(
+    file_path, settings, ids_path=None, milestone=MILESTONE, workers=None, verbose=True, incremental=True, grid=None, report=None,
+    requirement_cache=None, validate=False,
+):
+    """ Convert a single Excel file and save one .ids file per purpose next to it (or as ids_path with purpose suffixes).
+    With incremental, the purposes whose inputs didn't change since the last run (see the manifest) are not rewritten.
+    With validate, all the files are rewritten and checked, and the problems found are set as report.validation
+    (see validation_report). Files with problems are left out of the manifest, so that they are rebuilt on the next run.
+    Timings and counters are added to the report, if given.
+    Returns a dictionary of purpose -> path of the saved .ids file.
+    """
+    if report is None:
+        report = Report()
+    if ids_path is None:
+        ids_path = file_path.replace(".xlsx", ".ids")
+    if grid is None:
+        with report.stage('read_grid'):
+            grid = read_grid(file_path, settings)
+    report.count('cells_read', grid.max_row * grid.max_column)
+    manifest_path = ids_path.replace(".ids", ".manifest.json")
+    with report.stage('input_hashes'):
+        hashes = input_hashes(grid, settings, milestone)
+    # validation needs the specifications of every file, to point at the cells of the problems found
+    previous = read_manifest(manifest_path) if incremental and not validate else {}
+    stale = set()
+    for purpose, purpose_hash in hashes["purposes"].items():
+        if previous.get("purposes", {}).get(purpose) != purpose_hash or not os.path.exists(ids_file_path(ids_path, purpose)):
+            stale.add(purpose)
+    ids_list = excel2ids(
+        grid, settings, milestone=milestone, verbose=verbose, purposes=stale, report=report, requirement_cache=requirement_cache
     )
+    ### Save all IDSes to files:
+    with report.stage('save_ids_files'):
+        paths = save_ids_files(ids_list, ids_path, workers=workers, verbose=verbose, validation='lax' if validate else 'strict')
+    for purpose, path in paths.items():
+        report.bytes_written[purpose] = os.path.getsize(path)
+    report.count('files_written', len(paths))
+    if validate:
+        with report.stage('validate'):
+            problems = validate_ids_files(paths, workers=workers, verbose=verbose)
+            report.validation = validation_report(problems, ids_list, grid, settings)
+        report.count('validation_errors', sum(len(errors) for errors in report.validation.values()))
+    # only remember the purposes which have an up to date (and valid) file
+    hashes["purposes"] = {
+        purpose: purpose_hash for purpose, purpose_hash in hashes["purposes"].items()
+        if (purpose in paths or purpose not in stale) and not (validate and report.validation.get(purpose))
+    }
+    write_manifest(manifest_path, hashes)
+    if verbose:
+        unchanged = len(hashes["purposes"]) - len(paths)
+        print(
+            color_text(f"Success! {len(ids_list)} IDS files were saved in {os.path.dirname(ids_path)}"
+                       + (f", {unchanged} unchanged." if unchanged else "."), color='green')
+        )
+        if validate:
+            print_validation(report.validation)
+    return paths
+
+
+def print_validation(validation):
+    errors = [(purpose, error) for purpose, purpose_errors in validation.items() for error in purpose_errors]
+    for purpose, error in errors:
+        print(f"{purpose} {error['cell'] or ''}: {error['message']}")
+    print(color_text(f"{len(errors)} problems found in the IDS files." if errors else "All IDS files are valid.",
+                     color='red' if errors else 'green'))
+
+
+def convert_many(file_paths, settings, milestone=MILESTONE, workers=None, incremental=True, reports=None, validate=False):
+    """ Convert many Excel files in a pool of processes, each file independently of the others.
+    Returns a dictionary of file path -> result of convert(), or the exception raised for that file.
+    If a reports dictionary is given, it is filled with file path -> report of that conversion (as a dictionary).
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    results = {}
+    if workers is None:
+        workers = min(len(file_paths), os.cpu_count() or 1)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    convert_reported, file_path, settings, milestone=milestone, incremental=incremental, validate=validate
+                ): file_path
+                for file_path in file_paths
+            }
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]], report_dict = future.result()
+                    if reports is not None:
+                        reports[futures[future]] = report_dict
+                except Exception as e:
+                    results[futures[future]] = e
+    else:
+        for file_path in file_paths:
+            try:
+                results[file_path], report_dict = convert_reported(
+                    file_path, settings, milestone=milestone, incremental=incremental, validate=validate
+                )
+                if reports is not None:
+                    reports[file_path] = report_dict
+            except Exception as e:
+                results[file_path] = e
+    return results
 
-    # Close the spreadsheet
-    spreadsheet.close()
+
+def convert_reported(file_path, settings, **kwargs):
+    """ convert() a file without output in the terminal, returning the saved paths and the report as a dictionary """
+    report = Report()
+    paths = convert(file_path, settings, workers=1, verbose=False, report=report, **kwargs)
+    return paths, report.asdict()
+
+
+def column_purposes(purpose_cell):
+    return split_multivalue(purpose_cell) if not isempty(purpose_cell) else []
+
+
+def hash_values(*values):
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
+
+def input_hashes(grid, settings, milestone=MILESTONE):
+    """ Content hashes of everything each output depends on: the header, every specification column,
+    every requirement row and, combining those, every purpose.
+    """
+    import openpyxl
+    rows = grid.rows
+    start_row, start_col = settings.index['DEFAULT_START_CELL']
+    settings_values = {key: value for key, value in vars(settings).items() if key != 'index'}
+    header = hash_values(FORMAT_VERSION, sorted(settings_values.items()), milestone, [grid.cell(key) for key in CELL_KEYS])
+    column_keys = [key for key in settings.index if key.startswith(('SPE_', 'APL_'))]
+    requirement_rows = [
+        row for row in range(start_row, grid.max_row) if rows[row][settings.index['REQ_INCLUDE']]
+    ]
+    row_hashes = {row: hash_values(rows[row][:start_col]) for row in requirement_rows}
+    column_hashes = {}
+    purpose_inputs = {}
+    for col in range(start_col, grid.max_column):
+        if not rows[settings.index['APL_INCLUDE']][col]:
+            continue
+        marks = [(row, rows[row][col]) for row in requirement_rows if not isempty(rows[row][col])]
+        column_letter = openpyxl.utils.get_column_letter(col + 1)
+        column_hashes[column_letter] = hash_values(
+            [rows[settings.index[key]][col] for key in column_keys],
+            [(mark, row_hashes[row]) for row, mark in marks],
+        )
+        for purpose in column_purposes(rows[settings.index['APL_PURPOSE']][col]):
+            purpose_inputs.setdefault(purpose, []).append(column_hashes[column_letter])
+    return {
+        "header": header,
+        "columns": column_hashes,
+        "rows": {str(row + 1): row_hash for row, row_hash in row_hashes.items()},
+        "purposes": {purpose: hash_values(header, inputs) for purpose, inputs in purpose_inputs.items()},
+    }
+
+
+def read_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_manifest(manifest_path, hashes):
+    with open(manifest_path, 'w') as file:
+        json.dump(hashes, file, indent=1)
 
 
 def add_to_ids(
+    ids_list,
+    spec_index,
     applicability,
     requirements,
     apl_cardinality="required",
@@ -280,18 +751,22 @@ def add_to_ids(
     version="0.1",
     copyright="No copyright",
     description="",
+    column=None,
+    requirement_cells=(),
 ):
     """Add this specifiction to IDS file. If such IDS doesn't exist yet, create it.
+    column and requirement_cells (the cell of each requirement) record where the specification comes from in the sheet.
     TODO Known limitations: 
     - the applicability is automatically set to 'minOccur'=0, meaning 'if exists'/'may occur' and does not trigger an error if no such element is found.
     """
 
+    from ifctester import ids
     if isinstance(date,datetime.datetime):
         date = date.strftime("%Y-%m-%d")
 
     if not purpose in ids_list:
-        # create new IDS
-        ids_list[purpose] = ids.Ids(
+        # create new IDS (ids.Ids checks and formats the info)
+        ids_list[purpose] = IdsData(ids.Ids(
             title=title,
             author=author,
             version=str(version),
@@ -300,65 +775,284 @@ def add_to_ids(
             date=date,
             purpose=purpose,
             milestone=milestone
-        )
+        ).info)
 
     # check if this IDS already has such category (applicability)
-    exists = False
-    for spec in ids_list[purpose].specifications:
-        if spec.name == spec_name:
-            # ADD req!
-            spec.requirements += requirements
-            exists = True
-
-    if not exists:
+    specifications = ids_list[purpose].specifications
+    sources = ids_list[purpose].sources
+    position = spec_index.setdefault(purpose, {}).get(spec_name)
+    if position is not None:
+        # ADD req!
+        spec = specifications[position]
+        specifications[position] = spec._replace(requirements=spec.requirements + tuple(requirements))
+        columns, cells = sources[position]
+        sources[position] = (columns + (column,), cells + tuple(requirement_cells))
+    else:
         # create new spec
-        new_spec = ids.Specification(
-            name=spec_name,
-            minOccurs=1,
-            maxOccurs='unbounded',
+        min_occurs, max_occurs = 1, 'unbounded'
+        if apl_cardinality == 'prohibited':
+            min_occurs, max_occurs = 0, 0
+        elif apl_cardinality == 'optional':
+            min_occurs, max_occurs = 0, 'unbounded'
+
+        # facets are immutable, so they are shared by all the specifications using them
+        new_spec = SpecificationData(
+            name=spec_name or "Unnamed",
+            minOccurs=min_occurs,
+            maxOccurs=max_occurs,
             ifcVersion=ifc_version,
             identifier=spec_identifier,
             description=spec_description,
             instructions=spec_instructions,
+            applicability=tuple(applicability),
+            requirements=tuple(requirements),
         )
+        spec_index[purpose][new_spec.name] = len(specifications)
+        specifications.append(new_spec)
+        sources.append(((column,), tuple(requirement_cells)))
 
-        if apl_cardinality == 'prohibited':
-            new_spec.minOccurs=0
-            new_spec.maxOccurs=0
-        elif apl_cardinality == 'optional':
-            new_spec.minOccurs=0
-            new_spec.maxOccurs='unbounded'
 
-        new_spec.applicability = copy.deepcopy(applicability)
-        new_spec.requirements = copy.deepcopy(requirements)
-        ids_list[purpose].specifications.append(new_spec)
+def save_ids_files(ids_list, ids_path, workers=None, verbose=True, validation='strict'):
+    """ Write one .ids file per purpose, producing the same bytes as ids.Ids.to_xml().
+    Each distinct specification (by content) is rendered to XML only once, in parallel processes when
+    there is more than one CPU, and the same fragment is copied into every file that includes it.
+    With 'lax' validation, files with invalid values are saved anyway, to be checked with validate_ids_files.
+    Returns a dictionary of purpose -> path of the saved file.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+    paths = {purpose: ids_file_path(ids_path, purpose) for purpose in ids_list}
+    spec_keys = {} # purpose -> content hash of each of its specifications
+    unique_specs = {} # content hash -> specification
+    for purpose, new_ids in ids_list.items():
+        spec_keys[purpose] = []
+        for spec in new_ids.specifications:
+            key = hash_values(spec)
+            unique_specs.setdefault(key, spec)
+            spec_keys[purpose].append(key)
+    # the beginning of each file, with its info, is taken from its first specification rendered with that info
+    purposes = [purpose for purpose in ids_list if ids_list[purpose].specifications]
+    tasks = [(spec, None, validation) for spec in unique_specs.values()]
+    tasks += [(ids_list[purpose].specifications[0], ids_list[purpose].info, validation) for purpose in purposes]
+
+    if workers is None:
+        workers = min(len(tasks), os.cpu_count() or 1)
+    progress = dict(total=len(tasks), desc="Generating separate .ids files.", disable=not verbose)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(tasks) // (workers * 4))
+            rendered = list(tqdm(executor.map(render_specification, *zip(*tasks), chunksize=chunksize), **progress))
+    else:
+        rendered = [render_specification(*task) for task in tqdm(tasks, **progress)]
+    fragments = dict(zip(unique_specs, rendered))
+    heads = dict(zip(purposes, rendered[len(unique_specs):]))
 
+    for purpose, path in paths.items():
+        if purpose not in heads:
+            ids_list[purpose].to_ids().to_xml(path)
+            continue
+        head, _, tail, _ = heads[purpose]
+        # the 'xs' namespace is declared on the root only if any restriction is used in the whole document
+        if XS_NAMESPACE_DECLARATION not in head and any(fragments[key][3] for key in spec_keys[purpose]):
+            default_declaration = f' xmlns="{IDS_NAMESPACE}"'
+            head = head.replace(default_declaration, default_declaration + XS_NAMESPACE_DECLARATION, 1)
+        with open(path, 'w', encoding='utf-8', errors='xmlcharrefreplace', newline='') as file:
+            file.write("<?xml version='1.0' encoding='utf-8'?>\n" + head)
+            for key in spec_keys[purpose]:
+                file.write(fragments[key][1])
+            file.write(tail)
+    return paths
+
+
+def ids_file_path(ids_path, purpose):
+    return ids_path.replace(".ids", "_" + purpose + ".ids")
+
+
+IDS_NAMESPACE = "http://standards.buildingsmart.org/IDS"
+XS_NAMESPACE = "http://www.w3.org/2001/XMLSchema"
+XS_NAMESPACE_DECLARATION = f' xmlns:xs="{XS_NAMESPACE}"'
+
+def render_specification(spec, info=None, validation='strict'):
+    """ Encode the specification alone in an IDS document (with the given info) and split the XML around it.
+    Returns the text before the <specification> element, the element (with its indentation), the text after it
+    and whether the 'xs' namespace was used. With 'lax' validation, invalid values are written instead of raising.
+    """
+    from ifctester import ids
+    ET.register_namespace("", IDS_NAMESPACE)
+    envelope = ids.Ids()
+    if info is not None:
+        envelope.info = info
+    ids_dict = envelope.asdict()
+    ids_dict["specifications"]["specification"] = [spec.to_ids().asdict()]
+    encoded = ids.get_schema().encode(ids_dict, validation=validation)
+    if validation == 'lax':
+        encoded, _ = encoded
+    text = ET.tostring(encoded, encoding='unicode')
+    start = text.index("<specifications>") + len("<specifications>")
+    end = text.rindex("</specification>") + len("</specification>")
+    return text[:start], text[start:end], text[end:], XS_NAMESPACE_DECLARATION in text[:start]
+
+
+ATTRIBUTE_ERROR = re.compile(r"^attribute (\w+)=")
+
+def validate_ids_files(paths, workers=None, verbose=True):
+    """ Check the saved .ids files (a dictionary of purpose -> path), in parallel processes when there is more than one CPU.
+    Returns a dictionary of purpose -> problems found in that file (see validate_ids_file).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+    purposes = list(paths)
+    if workers is None:
+        workers = min(len(purposes), os.cpu_count() or 1)
+    progress = dict(total=len(purposes), desc="Validating .ids files.", disable=not verbose)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            problems = list(tqdm(executor.map(validate_ids_file, [paths[purpose] for purpose in purposes]), **progress))
+    else:
+        problems = [validate_ids_file(paths[purpose]) for purpose in tqdm(purposes, **progress)]
+    return dict(zip(purposes, problems))
 
-QUOTED_PATTERN = r'^".*"$'
 
+def validate_ids_file(path):
+    """ Validate an .ids file against the IDS 1.0 schema bundled with IfcTester (compiled once per process),
+    and check that every pattern restriction is a valid XSD regular expression.
+    Returns a list of problems, each a dictionary with the message and the place of the problem in the file:
+    the info or specification (index), block (applicability or requirements), facet (kind and index among the facets of
+    that kind, as they are grouped by kind in the document) and field.
+    """
+    from ifctester import ids
+    from elementpath.regex import translate_pattern, RegexError
+    root = ET.parse(path).getroot()
+    parents = {child: parent for parent in root.iter() for child in parent}
+    errors = []
+    for error in ids.get_schema().iter_errors(root, namespaces={'xs': XS_NAMESPACE}):
+        attribute = ATTRIBUTE_ERROR.match(error.reason or '')
+        errors.append((error.elem, attribute and attribute.group(1), error.reason))
+    for pattern in root.iter(f'{{{XS_NAMESPACE}}}pattern'):
+        try:
+            re.compile(translate_pattern(pattern.get('value'), back_references=False, lazy_quantifiers=False, anchors=False))
+        except (RegexError, re.error) as e:
+            errors.append((pattern, None, f"invalid pattern '{pattern.get('value')}': {e}"))
+    return [dict(locate_element(element, parents, attribute), message=message) for element, attribute, message in errors]
+
+
+def locate_element(element, parents, attribute=None):
+    """ The place of an element of an IDS document, in the terms of the spreadsheet (see validate_ids_file) """
+    chain = [element]
+    while chain[-1] in parents:
+        chain.append(parents[chain[-1]])
+    chain.reverse() # ids, info or specifications, specification, block, facet, field, ...
+    names = [item.tag.rpartition('}')[2] for item in chain]
+    field = lambda depth: names[depth] if len(names) > depth else attribute
+    if len(names) < 2:
+        return {'field': attribute}
+    if names[1] == 'info':
+        return {'info': field(2)}
+    if len(names) < 3:
+        return {'field': attribute}
+    location = {'specification': list(chain[1]).index(chain[2])}
+    if len(names) == 3:
+        location['field'] = attribute
+    elif len(names) == 4:
+        location.update(block=names[3], field=attribute)
+    else:
+        same_kind = [facet for facet in chain[3] if facet.tag == chain[4].tag]
+        location.update(block=names[3], kind=names[4], facet=same_kind.index(chain[4]), field=field(5))
+    return location
+
+
+def validation_report(problems, ids_list, grid, settings):
+    """ Add the sheet cell (and settings key) causing each problem found by validate_ids_files. Returns a dictionary of
+    purpose -> list of problems, each with the cell, key, specification name and message.
+    """
+    import openpyxl
+    index = settings.index
+    report = {}
+    for purpose, purpose_problems in problems.items():
+        report[purpose] = []
+        for problem in purpose_problems:
+            cell, key, name = None, None, None
+            if 'info' in problem:
+                key = INFO_CELLS.get(problem['info'])
+                cell = index[key] if key else None
+            elif 'specification' in problem:
+                spec = ids_list[purpose].specifications[problem['specification']]
+                columns, requirement_cells = ids_list[purpose].sources[problem['specification']]
+                name = spec.name
+                field = problem.get('field')
+                if problem.get('block') == 'requirements' and 'facet' in problem:
+                    same_kind = [
+                        position for position, facet in enumerate(spec.requirements) if facet.kind.lower() == problem['kind'].lower()
+                    ]
+                    row, col = requirement_cells[same_kind[problem['facet']]]
+                    key = REQUIREMENT_CELLS.get(problem['kind'], {}).get(field)
+                    # values replacing 'REPLACEME' come from the mark itself
+                    if key and grid.rows[row][index[key]] != 'REPLACEME':
+                        col = index[key]
+                    cell = (row, col)
+                else:
+                    if problem.get('block') == 'applicability':
+                        key = APPLICABILITY_CELLS.get(problem.get('kind'), {}).get(field) or 'APL_CARDINAL'
+                    else:
+                        key = SPECIFICATION_CELLS.get(field, 'SPE_NAME')
+                    cell = index[key] if isinstance(index[key], tuple) else (index[key], columns[0])
+            report[purpose].append({
+                'cell': openpyxl.utils.get_column_letter(cell[1] + 1) + str(cell[0] + 1) if cell else None,
+                'key': key,
+                'specification': name,
+                'message': problem['message'],
+            })
+    return report
+
+
+VALUE_CACHE_SIZE = 65536
+QUOTED_PATTERN = re.compile(r'^".*"$')
+
+@functools.lru_cache(maxsize=VALUE_CACHE_SIZE, typed=True)
 def process_value(cell_value):
-    """ Look at the value and convert to enumeration or pattern if needed """
+    """ Look at the value and convert to enumeration or pattern if needed.
+    Results are cached by cell value, so the same text always gives the same (shared) Restriction.
+    """
     if not isempty(cell_value):
         if isinstance(cell_value, str):
             # remove trailing spaces
             cell_value=cell_value.strip()
             # if it's in quotation, turn into pattern restriction (regex):
-            if bool(re.match(QUOTED_PATTERN, cell_value)):
-                cell_value = ids.Restriction(options={"pattern": cell_value[1:-1]})
+            if QUOTED_PATTERN.match(cell_value):
+                cell_value = restriction("pattern", cell_value[1:-1])
             # if there are multiple lines in a single cell, split it into enumeration of literal values
             elif "\n" in cell_value or "," in cell_value or ";" in cell_value:
-                cell_value = ids.Restriction(options={"enumeration": split_multivalue(cell_value)})
+                cell_value = restriction("enumeration", tuple(split_multivalue(cell_value)))
             # in other cases, return as is (empty or literal value)
         elif isinstance(cell_value, bool):
             cell_value=str(cell_value)
     return cell_value
 
 
-SPLIT_PATTERN=r'\s*[,;\n]\s*'
+@functools.lru_cache(maxsize=VALUE_CACHE_SIZE)
+def restriction(constraint, value):
+    """ One shared restriction per distinct pattern or enumeration (given as a tuple) """
+    return RestrictionData(constraint, value)
+
+
+SPLIT_PATTERN = re.compile(r'\s*[,;\n]\s*')
 
 def split_multivalue(text):
     """ Split discipline/phase text if plural (allowed multiline, comma-separated and semicolon-separated).  """
-    return re.split(SPLIT_PATTERN, text)
+    return list(_split_multivalue(text))
+
+
+@functools.lru_cache(maxsize=VALUE_CACHE_SIZE)
+def _split_multivalue(text):
+    return tuple(SPLIT_PATTERN.split(text))
+
+
+def value_cache_info():
+    """ Hits, misses and sizes of the value parsing caches """
+    return {
+        cache.__name__.lstrip('_'): cache.cache_info()._asdict()
+        for cache in (process_value, restriction, _split_multivalue)
+    }
 
 
 def color_text(text, color='blue'):
@@ -371,7 +1065,7 @@ def color_text(text, color='blue'):
     return text
 
 
-def ask_for_path():
+def ask_for_path(settings, pause=True):
     file_path = input(color_text("\nPlease enter the path to the Excel spreadsheet: \n"))
     if file_path[0] == '"':
         file_path = file_path[1:]
@@ -379,33 +1073,240 @@ def ask_for_path():
         file_path = file_path[:-1]
     if file_path[-5:] != '.xlsx':
         print(color_text("\nThe file must be an .xlsx. Please check the path and try again.", color='red'))
-        ask_for_path()
+        return ask_for_path(settings, pause)
     try:
-        spreadsheet = openpyxl.load_workbook(file_path)
-        return spreadsheet, file_path
+        grid = read_grid(file_path, settings)
+        return grid, file_path
     except FileNotFoundError:
         print(color_text("\nThe file was not found. Please check the path and try again.", color='red'))
-        ask_for_path()
+        return ask_for_path(settings, pause)
     except Exception as e:
         print(color_text(f"\nAn error occurred: {e}", color='red'))
-        print(color_text("\nThe program will close automatically in 10 seconds...\n"))
-        time.sleep(10)
+        if pause:
+            print(color_text("\nThe program will close automatically in 10 seconds...\n"))
+            time.sleep(10)
         sys.exit()
 
 
-if __name__ == "__main__": 
+def find_workbooks(patterns):
+    """ Expand directories and glob patterns to a sorted list of .xlsx files """
+    file_paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.xlsx')
+        for file_path in glob.glob(pattern):
+            # skip the lock files Excel creates next to open workbooks
+            if file_path.endswith('.xlsx') and not os.path.basename(file_path).startswith('~$'):
+                file_paths.add(file_path)
+    return sorted(file_paths)
+
+
+# seconds to wait before converting a file again after a failure, in case Excel was still writing it
+RETRY_DELAYS = (1, 2, 4)
 
-    s = Settings('settings.json')
-    ids_list = {}
 
-    spreadsheet, file_path = ask_for_path()
-    ids_path = file_path.replace(".xlsx", ".ids")
+class Watcher:
+    """ Converts the watched Excel files again each time they are saved.
+    Settings, parsed requirement rows (per file) and parsed cell values stay in memory between conversions, and
+    only the IDS files whose inputs changed are written (see convert). Files are written in this process,
+    as a save usually affects few purposes and starting worker processes would take longer.
+    A file which fails to convert is tried again after each of RETRY_DELAYS, then only once it is saved again.
+    """
+    def __init__(self, patterns, settings, milestone=MILESTONE, interval=0.5):
+        self.patterns = patterns
+        self.settings = settings
+        self.milestone = milestone
+        self.interval = interval
+        self.mtimes = {}
+        self.failures = {} # file path -> (failed attempts, time of the next attempt or None)
+        self.requirement_caches = {}
+        self.lock = threading.Lock()
+
+    def poll(self):
+        file_paths = find_workbooks(self.patterns)
+        for file_path in self.requirement_caches.keys() - set(file_paths):
+            del self.requirement_caches[file_path]
+        for file_path in file_paths:
+            try:
+                mtime = os.stat(file_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            changed = self.mtimes.get(file_path) != mtime
+            attempts, retry_time = self.failures.get(file_path, (0, None))
+            if not changed and (retry_time is None or time.monotonic() < retry_time):
+                continue
+            self.mtimes[file_path] = mtime
+            if changed:
+                attempts = 0
+            if self.convert(file_path):
+                self.failures.pop(file_path, None)
+            else:
+                delay = RETRY_DELAYS[attempts] if attempts < len(RETRY_DELAYS) else None
+                self.failures[file_path] = (attempts + 1, None if delay is None else time.monotonic() + delay)
+
+    def convert(self, file_path):
+        start = time.perf_counter()
+        try:
+            with self.lock:
+                paths = convert(
+                    file_path, self.settings, milestone=self.milestone, workers=1, verbose=False,
+                    requirement_cache=self.requirement_caches.setdefault(file_path, {}),
+                )
+        except Exception as e:
+            # Excel may still be writing the file (see RETRY_DELAYS)
+            print(color_text(f"{file_path}: {type(e).__name__}: {e}", color='red'))
+            return False
+        saved = ', '.join(os.path.basename(path) for path in paths.values()) or 'no changes'
+        print(f"{datetime.datetime.now():%H:%M:%S} {file_path}: {saved} ({time.perf_counter() - start:.2f} s)")
+        return True
+
+    def ids_files(self):
+        """ Dictionary of Excel file name (without extension) -> purpose -> path of the current .ids file """
+        files = {}
+        for file_path in self.mtimes:
+            ids_path = file_path.replace(".xlsx", ".ids")
+            purposes = read_manifest(ids_path.replace(".ids", ".manifest.json")).get("purposes", {})
+            files[os.path.basename(file_path)[:-5]] = {purpose: ids_file_path(ids_path, purpose) for purpose in purposes}
+        return files
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Serve the generated IDS files over HTTP in a background thread:
+        GET / lists the files, GET /<Excel file name>/<purpose>.ids returns the IDS.
+        """
+        import http.server
+        import urllib.parse
+        watcher = self
 
-    MILESTONE = 'LOD400' #TODO TEMP workaround for phases/milestones
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                files = watcher.ids_files()
+                parts = urllib.parse.unquote(self.path).strip('/').split('/')
+                if parts == ['']:
+                    body = json.dumps({name: sorted(purposes) for name, purposes in files.items()}, indent=1).encode()
+                    return self.reply(200, 'application/json', body)
+                if len(parts) == 2 and parts[1].endswith('.ids'):
+                    path = files.get(parts[0], {}).get(parts[1][:-4])
+                    if path and os.path.exists(path):
+                        with watcher.lock, open(path, 'rb') as file:
+                            body = file.read()
+                        return self.reply(200, 'application/xml', body)
+                self.reply(404, 'text/plain', b'Not found')
 
-    excel2ids(spreadsheet, ids_path)
+            def reply(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
 
-    time.sleep(1)
-    print(color_text("\nThe program will close automatically in 5 seconds...\n"))
-    time.sleep(6)
-    sys.exit()
\ No newline at end of file
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(color_text(f"Serving the IDS files on http://{host}:{server.server_address[1]}/"))
+        return server
+
+    def run(self):
+        print(color_text("Watching for changes, press Ctrl+C to stop."))
+        try:
+            while True:
+                self.poll()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+
+
+def interactive(settings, incremental=True, report=None, validate=False, pause=True):
+    """ Ask for a spreadsheet and convert it. With pause, wait before returning so that the console window
+    (of the executable started with a double click) stays open long enough to read the result.
+    """
+    grid, file_path = ask_for_path(settings, pause)
+    convert(file_path, settings, incremental=incremental, grid=grid, report=report, validate=validate)
+
+    if pause:
+        time.sleep(1)
+        print(color_text("\nThe program will close automatically in 5 seconds...\n"))
+        time.sleep(6)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate IDS files from Excel2IDS spreadsheets.")
+    parser.add_argument('paths', nargs='*', help="Excel files, directories or glob patterns. Asks for a path if omitted.")
+    parser.add_argument('--settings', default='settings.json', help="Path to the settings file (default: settings.json).")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: one per CPU).")
+    parser.add_argument('--milestone', default=MILESTONE, help=f"Milestone written to all IDS files (default: {MILESTONE}).")
+    parser.add_argument('--force', action='store_true', help="Rewrite all IDS files, even if their inputs didn't change.")
+    parser.add_argument('--watch', action='store_true', help="Keep running and convert the files again whenever they are saved.")
+    parser.add_argument('--serve', type=int, metavar='PORT', help="With --watch, serve the IDS files on http://127.0.0.1:PORT/.")
+    parser.add_argument('--report', help="Save timings and counters of the run to this JSON file.")
+    parser.add_argument('--profile', help="Profile the run with cProfile and save the stats to this file (uses one process).")
+    parser.add_argument('--trace-memory', action='store_true', help="Record the peak memory in the report (slower, uses one process).")
+    parser.add_argument('--validate', action='store_true', help="Check the saved IDS files against the IDS schema.")
+    parser.add_argument('--no-pause', action='store_true', help="Exit as soon as the file is converted, without the closing delay.")
+    args = parser.parse_args(argv)
+
+    settings = Settings(args.settings)
+    report = Report(profile_path=args.profile, trace_memory=args.trace_memory)
+    if not args.paths:
+        report.start()
+        try:
+            interactive(settings, incremental=not args.force, report=report, validate=args.validate, pause=not args.no_pause)
+        finally:
+            report.stop()
+        if args.report:
+            save_report(args.report, report.asdict())
+        return 0
+
+    if args.watch:
+        watcher = Watcher(args.paths, settings, milestone=args.milestone)
+        if args.serve is not None:
+            watcher.serve(args.serve)
+        watcher.run()
+        return 0
+
+    file_paths = find_workbooks(args.paths)
+    if not file_paths:
+        print(color_text("No .xlsx files found.", color='red'))
+        return 2
+    workers = args.workers
+    if args.profile or args.trace_memory:
+        # the profiler and tracemalloc only see this process, so the files are converted in it
+        workers = 1
+    reports = {}
+    report.start()
+    with report.stage('total'):
+        results = convert_many(
+            file_paths, settings, milestone=args.milestone, workers=workers, incremental=not args.force, reports=reports,
+            validate=args.validate,
+        )
+    report.stop()
+    for report_dict in reports.values():
+        for name, n in report_dict['counters'].items():
+            report.count(name, n)
+    if args.report:
+        save_report(args.report, {'total': report.asdict(), 'files': reports})
+    failed = invalid = 0
+    for file_path in file_paths:
+        result = results[file_path]
+        if isinstance(result, Exception):
+            failed += 1
+            print(color_text(f"{file_path}: {type(result).__name__}: {result}", color='red'))
+        else:
+            print(f"{file_path}: {len(result)} IDS files saved." if result else f"{file_path}: no changes.")
+            skipped = reports[file_path]['counters'].get('columns_without_purpose')
+            if skipped:
+                print(color_text(f"{file_path}: {skipped} columns skipped, as they have no purpose.", color='red'))
+            if args.validate:
+                print_validation(reports[file_path]['validation'])
+                invalid += any(reports[file_path]['validation'].values())
+    print(color_text(
+        f"{len(file_paths) - failed} of {len(file_paths)} files converted.",
+        color='red' if failed else 'green'
+    ))
+    return 1 if failed or invalid else 0
+
+
+if __name__ == "__main__": 
+    multiprocessing.freeze_support()
+    sys.exit(main())
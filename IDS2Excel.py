@@ -0,0 +1,296 @@
+# IDS2Excel
+# Copyright (C) 2024 Artur Tomczak <artomczak@gmail.com>
+#
+# Reads .ids files (for example the ones saved by Excel2IDS, one per purpose) back into the Excel template:
+#
+#   python IDS2Excel.py "C:\Projects\MyTemplate_*.ids" --output MyTemplate.xlsx
+
+import os
+import sys
+import glob
+import argparse
+from collections import namedtuple
+from xml.etree import ElementTree as ET
+import openpyxl
+
+from Excel2IDS import Settings, CELL_KEYS, APPLICABILITY_CELLS, REQUIREMENT_CELLS, INFO_CELLS, color_text, isempty
+
+
+# characters with a special meaning in XSD regular expressions
+XSD_SPECIAL = set('\\|.-^?*+{}()[]')
+
+# Excel2IDS only builds a facet when the cell of this value is filled in
+REQUIRED_VALUES = {'entity': 'name', 'property': 'baseName', 'classification': 'system', 'attribute': 'name', 'material': 'value'}
+
+# A specification column: the SPE_ and APL_ cells, then the requirement rows it marks with 'X'
+Column = namedtuple('Column', ['cells', 'rows'])
+
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def escape_pattern(text):
+    return ''.join('\\' + char if char in XSD_SPECIAL else char for char in text)
+
+
+def read_value(element):
+    """ The text of a simpleValue, or a tuple of (constraint, value) pairs of an xs:restriction """
+    for child in element:
+        if local_name(child.tag) == 'simpleValue':
+            return child.text or ''
+        if local_name(child.tag) == 'restriction':
+            return tuple((local_name(option.tag), option.get('value')) for option in child)
+    return None
+
+
+def cell_value(value, warnings):
+    """ The cell text giving back the same value in Excel2IDS (see process_value): literals as they are,
+    enumerations one per line and patterns in quotation marks.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        # literals that Excel2IDS would read as an enumeration or a pattern become a pattern matching only themselves
+        if any(separator in value for separator in ',;\n') or (len(value) > 1 and value[0] == value[-1] == '"'):
+            return '"' + escape_pattern(value) + '"'
+        return value
+    constraints = {constraint for constraint, _ in value}
+    if constraints == {'enumeration'}:
+        options = [option for _, option in value]
+        if not any(',' in option or ';' in option or '\n' in option or option.startswith('"') for option in options):
+            return '\n'.join(options)
+        return '"' + '|'.join(escape_pattern(option) for option in options) + '"'
+    if constraints == {'pattern'}:
+        patterns = [pattern for _, pattern in value]
+        return '"' + (patterns[0] if len(patterns) == 1 else '|'.join(f'({pattern})' for pattern in patterns)) + '"'
+    warnings.add(f"restrictions with {', '.join(sorted(constraints - {'enumeration', 'pattern'}))}")
+    return None
+
+
+def read_facet(element, cell_keys, warnings):
+    """ Map the values of a facet to the cells given by cell_keys, as a tuple of (key, value) pairs """
+    kind = local_name(element.tag)
+    if kind not in cell_keys:
+        warnings.add(f"{kind} facets")
+        return None
+    names = cell_keys[kind]
+    cells = {}
+    for name, value in element.attrib.items():
+        if name in names:
+            cells[names[name]] = value
+        elif name not in ('minOccurs', 'maxOccurs'):
+            warnings.add(f"'{name}' of {kind} facets")
+    for child in element:
+        name = local_name(child.tag)
+        if name in names:
+            cells[names[name]] = cell_value(read_value(child), warnings)
+        else:
+            warnings.add(f"'{name}' of {kind} facets")
+    if isempty(cells.get(names[REQUIRED_VALUES[kind]])):
+        # for example any material required: an empty row would be left out when read back
+        warnings.add(f"{kind} facets without '{REQUIRED_VALUES[kind]}'")
+        return None
+    if 'REQ_CARDINAL' in names.values():
+        cells.setdefault('REQ_CARDINAL', 'required')
+    return tuple(sorted(cells.items()))
+
+
+def read_specification(element, warnings):
+    """ The SPE_ and APL_ cells of a specification and its requirements, as tuples of (key, value) pairs """
+    cells = {
+        'SPE_NAME': element.get('name'),
+        'SPE_DESCR': element.get('description'),
+        'SPE_INSTR': element.get('instructions'),
+        'SPE_IDENT': element.get('identifier'),
+    }
+    requirements = []
+    for block in element:
+        if local_name(block.tag) == 'applicability':
+            if block.get('maxOccurs') == '0':
+                cells['APL_CARDINAL'] = 'prohibited'
+            elif block.get('minOccurs') == '0':
+                cells['APL_CARDINAL'] = 'optional'
+            else:
+                cells['APL_CARDINAL'] = 'required'
+            for facet in block:
+                facet_cells = read_facet(facet, APPLICABILITY_CELLS, warnings)
+                if facet_cells is None:
+                    continue
+                if any(key in cells for key, _ in facet_cells):
+                    # the template has room for one facet of each kind in the applicability
+                    warnings.add(f"several {local_name(facet.tag)} facets in an applicability")
+                    continue
+                cells.update(facet_cells)
+        elif local_name(block.tag) == 'requirements':
+            for facet in block:
+                facet_cells = read_facet(facet, REQUIREMENT_CELLS, warnings)
+                if facet_cells is not None:
+                    requirements.append(facet_cells)
+    return tuple(sorted(cells.items())), tuple(requirements)
+
+
+def iter_specifications(file_path, info, warnings):
+    """ Stream the specifications of an .ids file, filling info on the way.
+    Each specification element is dropped once read, so the memory used doesn't grow with the file.
+    """
+    specifications = None
+    for event, element in ET.iterparse(file_path, events=('start', 'end')):
+        name = local_name(element.tag)
+        if event == 'start':
+            if name == 'specifications':
+                specifications = element
+        elif name == 'info':
+            info.update((local_name(child.tag), child.text) for child in element)
+            element.clear()
+        elif name == 'specification':
+            yield element.get('ifcVersion'), read_specification(element, warnings)
+            specifications.remove(element)
+
+
+def ids2excel(ids_paths, settings, xlsx_path, verbose=True):
+    """ Merge the specifications of the .ids files into a single spreadsheet in the layout of settings.
+    Specifications with the same name and content in several files (purposes) become one column for all those purposes,
+    and each distinct requirement becomes one row, marked with 'X' in the columns using it.
+    Only the distinct columns and rows are kept in memory. Returns the numbers of specifications, columns and rows.
+    """
+    header = {}
+    columns = {} # specification cells -> requirement rows -> [purposes]
+    rows = {} # (requirement cells, occurrence) -> row number
+    warnings = set()
+    count = 0
+    for ids_path in ids_paths:
+        info = {}
+        for ifc_version, (cells, requirements) in iter_specifications(ids_path, info, warnings):
+            count += 1
+            header.setdefault('IFC_VERSION', ifc_version)
+            # a requirement repeated in a specification needs as many identical rows, as each row is marked once
+            occurrences = {}
+            requirement_rows = []
+            for requirement in requirements:
+                occurrence = occurrences.get(requirement, 0)
+                occurrences[requirement] = occurrence + 1
+                requirement_rows.append(rows.setdefault((requirement, occurrence), len(rows)))
+            requirement_rows = tuple(requirement_rows)
+            purpose = info.get('purpose') or os.path.splitext(os.path.basename(ids_path))[0]
+            purposes = columns.setdefault(cells, {}).setdefault(requirement_rows, [])
+            if purpose not in purposes:
+                purposes.append(purpose)
+        for name, key in INFO_CELLS.items():
+            if not isempty(info.get(name)):
+                header.setdefault(key, info[name])
+
+    renamed = []
+    write_workbook(xlsx_path, settings, header, unique_names([
+        Column(cells + (('APL_PURPOSE', ', '.join(purposes)),), requirement_rows)
+        for cells, variants in columns.items() for requirement_rows, purposes in variants.items()
+    ], renamed), [requirement for requirement, _ in rows])
+
+    for warning in sorted(warnings):
+        print(color_text(f"Not supported by the template, skipped: {warning}.", color='red'))
+    for name, new_name in renamed:
+        print(color_text(f"Several specifications named '{name}' for the same purpose, one was renamed to '{new_name}'.", color='red'))
+    result = {'specifications': count, 'columns': sum(len(variants) for variants in columns.values()), 'rows': len(rows)}
+    if verbose:
+        print(color_text(f"Success! {result['specifications']} specifications saved as {result['columns']} columns "
+                         f"and {result['rows']} requirement rows in {xlsx_path}", color='green'))
+    return result
+
+
+def unique_names(columns, renamed):
+    """ Rename the columns sharing a name and a purpose with an earlier column, as Excel2IDS would merge them into
+    a single specification (keeping only the applicability of the first one). Adds (old, new name) pairs to renamed.
+    """
+    taken = set() # (name, purpose)
+    result = []
+    for column in columns:
+        cells = dict(column.cells)
+        purposes = cells['APL_PURPOSE'].split(', ')
+        name = new_name = cells['SPE_NAME'] or "Unnamed"
+        number = 1
+        while any((new_name, purpose) in taken for purpose in purposes):
+            number += 1
+            new_name = f"{name} ({number})"
+        if new_name != name:
+            renamed.append((name, new_name))
+            cells['SPE_NAME'] = new_name
+            column = column._replace(cells=tuple(cells.items()))
+        taken.update((new_name, purpose) for purpose in purposes)
+        result.append(column)
+    return result
+
+
+def write_workbook(xlsx_path, settings, header, columns, requirements):
+    """ Write the spreadsheet row by row in write-only mode. Keys of the settings label the rows and columns. """
+    index = settings.index
+    start_row, start_col = index['DEFAULT_START_CELL']
+    width = start_col + len(columns)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet(settings.SHEET_NAME)
+
+    top = [[None] * width for _ in range(start_row)]
+    def label(row, col, text):
+        if 0 <= col and top[row][col] is None:
+            top[row][col] = text
+    for key in CELL_KEYS:
+        if key in header:
+            row, col = index[key]
+            top[row][col] = header[key]
+    for col, column in enumerate(columns, start_col):
+        for key, value in column.cells:
+            top[index[key]][col] = value
+        top[index['APL_INCLUDE']][col] = True
+    for key in CELL_KEYS:
+        if key != 'DEFAULT_START_CELL':
+            label(index[key][0], index[key][1] - 1, key)
+    for key, position in index.items():
+        if key.startswith(('SPE_', 'APL_')):
+            label(position, start_col - 1, key)
+        elif key.startswith('REQ_'):
+            label(start_row - 1, position, key)
+    for values in top:
+        sheet.append(values)
+
+    marks = {}
+    for col, column in enumerate(columns, start_col):
+        for row in column.rows:
+            marks.setdefault(row, []).append(col)
+    for row, cells in enumerate(requirements):
+        values = [None] * width
+        for key, value in cells:
+            values[index[key]] = value
+        values[index['REQ_INCLUDE']] = True
+        for col in marks.get(row, []):
+            values[col] = 'X'
+        sheet.append(values)
+    workbook.save(xlsx_path)
+
+
+def find_ids_files(patterns):
+    """ Expand directories and glob patterns to a sorted list of .ids files """
+    file_paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.ids')
+        file_paths.update(file_path for file_path in glob.glob(pattern) if file_path.endswith('.ids'))
+    return sorted(file_paths)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Read IDS files back into the Excel2IDS spreadsheet.")
+    parser.add_argument('paths', nargs='+', help="IDS files, folders or glob patterns, merged into a single spreadsheet.")
+    parser.add_argument('--output', '-o', help="Spreadsheet to write (default: the first IDS file with .xlsx).")
+    parser.add_argument('--settings', default='settings.json')
+    args = parser.parse_args(argv)
+
+    ids_paths = find_ids_files(args.paths)
+    if not ids_paths:
+        print(color_text("No IDS files found.", color='red'))
+        return 2
+    settings = Settings(args.settings)
+    ids2excel(ids_paths, settings, args.output or ids_paths[0].replace('.ids', '.xlsx'))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,363 @@
+# Excel2IDS benchmark
+# Copyright (C) 2024 Artur Tomczak <artomczak@gmail.com>
+#
+# Generates synthetic spreadsheets in the layout described by settings.json and measures
+# each stage of the conversion. Results are saved as JSON and can be compared to a baseline:
+#
+#   python benchmark.py --case medium --save baseline.json
+#   python benchmark.py --case medium --baseline baseline.json
+#
+# --startup measures how long the tool takes to start instead, and fails if it's over the budget:
+#
+#   python benchmark.py --startup
+#   python benchmark.py --startup --executable dist\Excel2IDS.exe
+#   python benchmark.py --startup --executable dist\Excel2IDS.exe --stub dist\stub.exe
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import platform
+import tempfile
+import importlib
+import subprocess
+import tracemalloc
+import openpyxl
+
+import Excel2IDS
+
+
+CASES = {
+    'small': dict(columns=50, rows=100, density=0.1, purposes=5, replaceme=0.1, enumeration=5),
+    'medium': dict(columns=300, rows=400, density=0.05, purposes=15, replaceme=0.1, enumeration=10),
+    'large': dict(columns=1000, rows=1000, density=0.03, purposes=25, replaceme=0.1, enumeration=20),
+}
+
+NOISE_SECONDS = 0.01
+
+# seconds the tool may take to start, on top of starting the Python interpreter (or a trivial frozen program)
+STARTUP_BUDGET = 0.2
+# seconds the one-file executable may take to start in total, including unpacking it, when no stub is timed
+EXECUTABLE_STARTUP_BUDGET = 2.0
+
+STAGES = ['read_grid', 'read_requirement_rows', 'index_marks', 'excel2ids', 'add_to_ids', 'save_ids_files']
+
+
+def generate_workbook(file_path, settings, columns=50, rows=100, density=0.1, purposes=5, replaceme=0.1, enumeration=5, seed=0):
+    """ Write a synthetic spreadsheet with the given number of specification columns and requirement rows.
+    density is the share of marked assignment cells, replaceme the share of 'REPLACEME' requirement rows
+    and enumeration the number of values in the enumerations used in the table.
+    """
+    rnd = random.Random(seed)
+    index = settings.index
+    start_row, start_col = index['DEFAULT_START_CELL']
+    width = start_col + columns
+    table = [[None] * width for _ in range(start_row + rows)]
+
+    # metadata
+    for key, value in [
+        ('IDS_TITLE', 'Synthetic IDS'), ('IDS_AUTHOR', 'benchmark@example.com'), ('IDS_DATE', datetime.datetime(2024, 1, 1)),
+        ('IDS_VERSION', 1.0), ('IFC_VERSION', 'IFC4X3_ADD2'), ('IDS_DESCRIPTION', 'Generated by benchmark.py'),
+    ]:
+        row, col = index[key]
+        table[row][col] = value
+
+    enumeration_value = ', '.join(f'Value{i}' for i in range(enumeration))
+    purpose_names = [f'P{i:02}' for i in range(purposes)]
+    for col in range(start_col, width):
+        def put(key, value):
+            table[index[key]][col] = value
+        put('SPE_NAME', f'Specification {col - start_col}')
+        put('SPE_DESCR', 'Synthetic specification')
+        put('APL_CARDINAL', rnd.choice(['required', 'optional', 'prohibited']))
+        put('APL_ENTITY', rnd.choice(['IFCWALL', 'IFCDOOR\nIFCWINDOW', '"IFC.*"']))
+        if rnd.random() < 0.3:
+            put('APL_PSET', 'Pset_Common')
+            put('APL_PNAME', 'IsExternal')
+            put('APL_PVAL', True)
+            put('APL_PDTYPE', 'IFCBOOLEAN')
+        if rnd.random() < 0.2:
+            put('APL_CLASS_SYS', 'Uniclass')
+            put('APL_CLASS_CODE', '"EF_\\d{2}"')
+        put('APL_PURPOSE', ', '.join(rnd.sample(purpose_names, rnd.randint(1, min(3, purposes)))))
+        put('APL_INCLUDE', True)
+
+    for row in range(start_row, start_row + rows):
+        def put(key, value):
+            table[row][index[key]] = value
+        put('REQ_INCLUDE', rnd.random() < 0.95)
+        put('REQ_CARDINAL', rnd.choice(['required', 'optional', 'prohibited']))
+        if rnd.random() < 0.3:
+            put('REQ_INSTRUCTIONS', f'Instructions for row {row + 1}')
+        is_replaceme = rnd.random() < replaceme
+        kind = rnd.random()
+        if kind < 0.1:
+            put('REQ_ENTITY', 'REPLACEME' if is_replaceme else 'IFCSLAB')
+        elif kind < 0.7:
+            put('REQ_PSET', f'Pset_{row % 20}')
+            put('REQ_PNAME', 'REPLACEME' if is_replaceme else f'Property_{row + 1}')
+            put('REQ_PDTYPE', rnd.choice(['IFCLABEL', 'IFCREAL', 'IFCBOOLEAN']))
+            if not is_replaceme and rnd.random() < 0.5:
+                put('REQ_PVAL', rnd.choice([enumeration_value, '"[A-Z]{2}\\d+"', 12.5, 'Literal']))
+        elif kind < 0.85:
+            put('REQ_CLASS_SYS', 'Uniclass')
+            put('REQ_CLASS_CODE', 'REPLACEME' if is_replaceme else '"Pr_.*"')
+        elif kind < 0.95:
+            put('REQ_ANAME', 'Name')
+            put('REQ_AVALUE', 'REPLACEME' if is_replaceme else enumeration_value)
+        else:
+            put('REQ_MATERIAL', 'REPLACEME' if is_replaceme else '".*[Ss]teel.*"')
+        for col in range(start_col, width):
+            if rnd.random() < density:
+                table[row][col] = rnd.choice(['Value1', 'Value2', enumeration_value]) if is_replaceme else 'X'
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet(settings.SHEET_NAME)
+    for values in table:
+        sheet.append(values)
+    workbook.save(file_path)
+
+
+class StageTimer:
+    """ Accumulates the wall time of every call to a module function, while active """
+    def __init__(self, name, results):
+        self.name = name
+        self.results = results
+        self.function = getattr(Excel2IDS, name)
+
+    def __enter__(self):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return self.function(*args, **kwargs)
+            finally:
+                self.results[self.name] = self.results.get(self.name, 0.0) + time.perf_counter() - start
+        setattr(Excel2IDS, self.name, timed)
+        return self
+
+    def __exit__(self, *exc):
+        setattr(Excel2IDS, self.name, self.function)
+
+
+def run_stages(file_path, settings, workers=1):
+    """ Convert file_path once, returning the seconds spent in each stage """
+    seconds = {}
+    output_path = file_path.replace('.xlsx', '.ids')
+    timers = [StageTimer(name, seconds) for name in ['read_requirement_rows', 'index_marks', 'add_to_ids']]
+    for timer in timers:
+        timer.__enter__()
+    try:
+        start = time.perf_counter()
+        grid = Excel2IDS.read_grid(file_path, settings)
+        seconds['read_grid'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ids_list = Excel2IDS.excel2ids(grid, settings, verbose=False)
+        seconds['excel2ids'] = time.perf_counter() - start
+    finally:
+        for timer in timers:
+            timer.__exit__()
+
+    start = time.perf_counter()
+    Excel2IDS.save_ids_files(ids_list, output_path, workers=workers, verbose=False)
+    seconds['save_ids_files'] = time.perf_counter() - start
+    return seconds
+
+
+def measure_memory(file_path, settings):
+    """ Peak of the memory allocated by Python in each of the main stages """
+    peaks = {}
+    tracemalloc.start()
+    try:
+        grid = Excel2IDS.read_grid(file_path, settings)
+        peaks['read_grid'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        ids_list = Excel2IDS.excel2ids(grid, settings, verbose=False)
+        peaks['excel2ids'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        Excel2IDS.save_ids_files(ids_list, file_path.replace('.xlsx', '.ids'), workers=1, verbose=False)
+        peaks['save_ids_files'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def import_modules():
+    """ Import the modules Excel2IDS imports lazily and compile the IDS schema, so that the first timed run doesn't include them """
+    for name in ('tqdm', 'concurrent.futures', 'ifctester.ids'):
+        importlib.import_module(name)
+    importlib.import_module('ifctester.ids').get_schema()
+
+
+def clear_caches():
+    for cache in (Excel2IDS.process_value, Excel2IDS.restriction, Excel2IDS._split_multivalue):
+        cache.cache_clear()
+
+
+def benchmark_case(name, params, settings, directory, repeat=3, workers=1, memory=True):
+    file_path = os.path.join(directory, f'{name}.xlsx')
+    start = time.perf_counter()
+    generate_workbook(file_path, settings, **params)
+    print(f"{name}: generated {params['columns']} x {params['rows']} in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+
+    # best of several runs, each starting with cold caches
+    import_modules()
+    runs = []
+    for _ in range(repeat):
+        clear_caches()
+        runs.append(run_stages(file_path, settings, workers=workers))
+    stages = {stage: {'seconds': min(run.get(stage, 0.0) for run in runs)} for stage in STAGES}
+    stages['total'] = {'seconds': min(run['read_grid'] + run['excel2ids'] + run['save_ids_files'] for run in runs)}
+    if memory:
+        clear_caches()
+        for stage, peak in measure_memory(file_path, settings).items():
+            stages[stage]['peak_bytes'] = peak
+    return {'name': name, 'params': params, 'file_size': os.path.getsize(file_path), 'stages': stages}
+
+
+def run_seconds(command, repeat):
+    """ Fastest wall time of running the command """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        runs.append(time.perf_counter() - start)
+    return min(runs)
+
+
+def import_times(script):
+    """ Cumulative import time in seconds of each module imported at the top level when starting the script,
+    from python -X importtime, slowest first.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', script, '--help'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # nested imports are indented
+        if cumulative.strip().isdigit() and not name.startswith('  '):
+            times[name.strip()] = int(cumulative) / 1e6
+    return dict(sorted(times.items(), key=lambda item: -item[1]))
+
+
+def measure_startup(repeat=5, executable=None, stub=None):
+    """ Time to start the tool and print its help, i.e. everything before it asks for a path, against the interpreter alone.
+    With executable (the frozen .exe), that is timed instead, against stub (a trivial program frozen the same way,
+    to leave out the bootloader and unpacking) if given, and there's no import breakdown.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Excel2IDS.py')
+    if executable:
+        return {
+            'executable': executable,
+            'seconds': run_seconds([executable, '--help'], repeat),
+            'interpreter': run_seconds([stub], repeat) if stub else 0.0,
+        }
+    return {
+        'seconds': run_seconds([sys.executable, script, '--help'], repeat),
+        'interpreter': run_seconds([sys.executable, '-c', 'pass'], repeat),
+        'imports': import_times(script),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """ Print the time of each stage relative to the baseline. Returns False if any stage got slower than tolerance. """
+    ok = True
+    baseline_cases = {case['name']: case for case in baseline.get('cases', [])}
+    for case in results['cases']:
+        base = baseline_cases.get(case['name'])
+        if not base or base['params'] != case['params']:
+            print(f"{case['name']}: no comparable baseline")
+            continue
+        for stage, values in case['stages'].items():
+            before = base['stages'].get(stage, {}).get('seconds')
+            if not before:
+                continue
+            ratio = values['seconds'] / before
+            # ignore differences too small to measure reliably
+            slower = ratio > tolerance and values['seconds'] - before > NOISE_SECONDS
+            ok = ok and not slower
+            print(f"{case['name']:>8} {stage:<22} {before:9.3f} s -> {values['seconds']:9.3f} s  x{ratio:5.2f}{'  SLOWER' if slower else ''}")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Excel2IDS conversion on synthetic spreadsheets.")
+    parser.add_argument('--case', action='append', choices=list(CASES), help="Predefined case(s) to run (default: small).")
+    for key, value in CASES['small'].items():
+        parser.add_argument(f'--{key}', type=type(value), help=f"Custom case: {key} (default for custom cases: {value}).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help="Number of timed runs per case; the fastest is kept.")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes used to save the .ids files.")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the (slower) tracemalloc pass.")
+    parser.add_argument('--settings', default='settings.json')
+    parser.add_argument('--save', help="Save the results to this JSON file.")
+    parser.add_argument('--baseline', help="Compare the results to a JSON file saved before with --save.")
+    parser.add_argument('--tolerance', type=float, default=1.2, help="Allowed slowdown against the baseline (default: 1.2).")
+    parser.add_argument('--startup', action='store_true', help="Measure the start up time of the tool instead.")
+    parser.add_argument('--executable', help="With --startup, the frozen executable to measure instead of Excel2IDS.py.")
+    parser.add_argument('--stub', help="With --executable, a trivial program frozen the same way, whose start up is subtracted.")
+    parser.add_argument('--budget', type=float, help=(
+        f"With --startup, maximum seconds on top of the interpreter or stub start (default: {STARTUP_BUDGET}), "
+        f"or in total for an executable without --stub (default: {EXECUTABLE_STARTUP_BUDGET})."
+    ))
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        startup = measure_startup(repeat=max(args.repeat, 5), executable=args.executable, stub=args.stub)
+        if args.budget is not None:
+            startup['budget'] = args.budget
+        elif args.executable and not args.stub:
+            startup['budget'] = EXECUTABLE_STARTUP_BUDGET
+        else:
+            startup['budget'] = STARTUP_BUDGET
+        if args.save:
+            with open(args.save, 'w') as file:
+                json.dump(startup, file, indent=1)
+        print(json.dumps(startup, indent=1))
+        seconds = startup['seconds'] - startup['interpreter']
+        if seconds > startup['budget']:
+            print(f"Start up took {seconds:.3f} s, over the budget of {startup['budget']:.3f} s", file=sys.stderr)
+            return 1
+        return 0
+
+    settings = Excel2IDS.Settings(args.settings)
+    cases = {name: dict(CASES[name]) for name in args.case or []}
+    custom = {key: getattr(args, key) for key in CASES['small'] if getattr(args, key) is not None}
+    if custom or not cases:
+        cases['custom' if custom else 'small'] = {**CASES['small'], **custom}
+    for params in cases.values():
+        params['seed'] = args.seed
+
+    results = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'cases': [],
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for name, params in cases.items():
+            results['cases'].append(
+                benchmark_case(name, params, settings, directory, repeat=args.repeat, workers=args.workers, memory=not args.no_memory)
+            )
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=1)
+    print(json.dumps(results, indent=1))
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        if not compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
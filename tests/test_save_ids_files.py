@@ -0,0 +1,61 @@
+import os
+
+import Excel2IDS
+import benchmark
+
+
+SETTINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'settings.json')
+
+
+def test_save_ids_files_matches_to_xml(tmp_path):
+    """ save_ids_files() splices separately rendered specifications together, the result must be the bytes of to_xml() """
+    settings = Excel2IDS.Settings(SETTINGS)
+    file_path = str(tmp_path / 'template.xlsx')
+    benchmark.generate_workbook(file_path, settings, columns=40, rows=60, density=0.15, purposes=4, replaceme=0.2, enumeration=3)
+    grid = Excel2IDS.read_grid(file_path, settings)
+    ids_list = Excel2IDS.excel2ids(grid, settings, verbose=False)
+
+    # the workbook covers restrictions, 'REPLACEME' rows and specifications shared by several purposes
+    start_row, _ = settings.index['DEFAULT_START_CELL']
+    assert any(row[settings.index['REQ_PNAME']] == 'REPLACEME' for row in grid.rows[start_row:])
+    specifications = [spec for new_ids in ids_list.values() for spec in new_ids.specifications]
+    assert len(set(specifications)) < len(specifications)
+    assert any(
+        isinstance(value, Excel2IDS.RestrictionData)
+        for spec in specifications for facet in spec.requirements for _, value in facet.parameters
+    )
+
+    paths = Excel2IDS.save_ids_files(ids_list, str(tmp_path / 'template.ids'), workers=1, verbose=False)
+    assert set(paths) == set(ids_list)
+    for purpose, path in paths.items():
+        expected_path = str(tmp_path / f'expected_{purpose}.ids')
+        ids_list[purpose].to_ids().to_xml(expected_path)
+        with open(path, 'rb') as file, open(expected_path, 'rb') as expected:
+            assert file.read() == expected.read()
+
+
+def test_save_ids_files_declares_xs_namespace(tmp_path):
+    """ The 'xs' namespace is declared on the root when only a later specification of the file uses a restriction """
+    from ifctester import ids
+    facet = Excel2IDS.facet
+    plain = Excel2IDS.SpecificationData(
+        'Plain', 1, 'unbounded', 'IFC4', None, None, None,
+        (facet('Entity', name='IFCWALL'),), (facet('Attribute', name='Name', value='A', cardinality='required'),)
+    )
+    restricted = Excel2IDS.SpecificationData(
+        'Restricted', 0, 'unbounded', 'IFC4', 'ID1', 'Description', None,
+        (facet('Entity', name=Excel2IDS.process_value('"IFC.*"')),),
+        (facet('Property', propertySet='Pset', baseName='Value', dataType='IFCLABEL', cardinality='optional',
+               value=Excel2IDS.process_value('A, B')),)
+    )
+    ids_list = {
+        'ARC': Excel2IDS.IdsData(ids.Ids(title='T', author='a@b.c', purpose='ARC').info, [plain, restricted]),
+        'MEP': Excel2IDS.IdsData(ids.Ids(title='T', author='a@b.c', purpose='MEP').info, [restricted]),
+        'STR': Excel2IDS.IdsData(ids.Ids(title='T', author='a@b.c', purpose='STR').info, [plain]),
+    }
+    paths = Excel2IDS.save_ids_files(ids_list, str(tmp_path / 'template.ids'), workers=1, verbose=False)
+    for purpose, path in paths.items():
+        expected_path = str(tmp_path / f'expected_{purpose}.ids')
+        ids_list[purpose].to_ids().to_xml(expected_path)
+        with open(path, 'rb') as file, open(expected_path, 'rb') as expected:
+            assert file.read() == expected.read()